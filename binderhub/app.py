@@ -10,8 +10,10 @@ import os
 import re
 import secrets
 import warnings
+import weakref
 from binascii import a2b_hex
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from glob import glob
 import tempfile
 from urllib.parse import urlparse
@@ -46,15 +48,15 @@ from traitlets.config import Application
 
 from .base import VersionHandler
 from .build import BuildExecutor, KubernetesBuildExecutor, KubernetesCleaner
-from .builder import BuildHandler
+from .builder import BuildHandler, keep_alive_build_handlers
 from .events import EventLog
 from .handlers.repoproviders import RepoProvidersHandlers
 from .health import HealthHandler, KubernetesHealthHandler
 from .launcher import Launcher
 from .log import log_request
 from .main import LegacyRedirectHandler, RepoLaunchUIHandler, UIHandler
+from .metrics import MetricsHandler, mark_process_dead
 from .rdm import RDMRedirectHandler, WEKO3RedirectHandler
-from .metrics import MetricsHandler
 from .quota import KubernetesLaunchQuota, LaunchQuota
 from .ratelimit import RateLimiter
 from .registry import DockerRegistry
@@ -997,7 +999,9 @@ class BinderHub(Application):
         if len(repo_token_store) == 0:
             repo_token_store = os.path.join(tempfile.mkdtemp(), 'tokenstore.db')
 
-        launch_quota = self.launch_quota_class(parent=self, executor=self.executor)
+        self.launch_quota = launch_quota = self.launch_quota_class(
+            parent=self, executor=self.executor
+        )
 
         # Construct a Builder so that we can extract parameters such as the
         # configuration or the version string to pass to /version and /health handlers
@@ -1023,7 +1027,13 @@ class BinderHub(Application):
                 "rate_limiter": RateLimiter(parent=self),
                 "use_registry": self.use_registry,
                 "build_class": self.build_class,
+                # build event streams that need keepalive events
+                "build_handlers": weakref.WeakSet(),
                 "registry": registry,
+                # without a registry, built images are looked up in the local
+                # docker daemon. One client is shared between requests,
+                # created on first use by BuildHandler.
+                "docker_client": None,
                 "traitlets_config": self.config,
                 "traitlets_parent": self,
                 "about_message": self.about_message,
@@ -1185,6 +1195,9 @@ class BinderHub(Application):
     def stop(self):
         self.http_server.stop()
         self.build_pool.shutdown()
+        self.launch_quota.stop()
+        self.keepalive_callback.stop()
+        mark_process_dead()
 
     async def watch_build_pods(self):
         warnings.warn(
@@ -1213,8 +1226,15 @@ class BinderHub(Application):
             xheaders=True,
         )
         self.http_server.listen(self.port)
+        # a single timer sends keepalive events on all build event streams
+        self.keepalive_callback = tornado.ioloop.PeriodicCallback(
+            partial(keep_alive_build_handlers, self.tornado_settings["build_handlers"]),
+            BuildHandler.KEEPALIVE_INTERVAL * 1000,
+        )
+        self.keepalive_callback.start()
         if self.builder_required:
             asyncio.ensure_future(self.watch_builders())
+            self.launch_quota.start()
         if run_loop:
             tornado.ioloop.IOLoop.current().start()
 
@@ -16,10 +16,26 @@ Longer term options include:
 - Duplicate the code here and in binderhub/binderspawner_mixin.py
 """
 
+import hashlib
+
 from tornado import web
 from traitlets import Bool, Unicode
 from traitlets.config import Configurable
 
+# label identifying the repo a singleuser pod is running,
+# so that BinderHub can count pods per repo with a label selector
+REPO_HASH_LABEL = "binder-repo-hash"
+
+
+def repo_hash_label_value(image):
+    """Get the value of REPO_HASH_LABEL for an image
+
+    The image name without the tag is unique per repo,
+    but may be longer than a label value is allowed to be.
+    """
+    image_no_tag = image.rsplit(":", 1)[0]
+    return hashlib.sha256(image_no_tag.encode("utf-8")).hexdigest()[:32]
+
 
 class BinderSpawnerMixin(Configurable):
     """
@@ -99,6 +115,12 @@ class BinderSpawnerMixin(Configurable):
                 raise web.HTTPError(400, "image required")
         if "image" in self.user_options:
             self.image = self.user_options["image"]
+            if hasattr(self, "extra_labels"):
+                # e.g. KubeSpawner
+                self.extra_labels = dict(
+                    self.extra_labels,
+                    **{REPO_HASH_LABEL: repo_hash_label_value(self.image)},
+                )
         return super().start()
 
     def get_env(self):
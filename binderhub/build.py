@@ -16,10 +16,16 @@ import kubernetes.config
 from kubernetes import client, watch
 from tornado.ioloop import IOLoop
 from tornado.log import app_log
+from tornado.queues import Queue
 from traitlets import Any, Bool, Dict, Integer, List, Unicode, default
 from traitlets.config import LoggingConfigurable
 
-from .utils import KUBE_REQUEST_TIMEOUT, ByteSpecification, rendezvous_rank
+from .utils import (
+    KUBE_REQUEST_TIMEOUT,
+    ByteSpecification,
+    json_loads,
+    rendezvous_rank,
+)
 
 
 class ProgressEvent:
@@ -34,6 +40,9 @@ class ProgressEvent:
 
         BUILD_STATUS_CHANGE = 1
         LOG_MESSAGE = 2
+        # a build task raised an exception, the payload is the failed event
+        # to send to the client. No more events follow.
+        BUILD_ERROR = 3
 
     class BuildStatus(Enum):
         """
@@ -48,7 +57,7 @@ class ProgressEvent:
         FAILED = "failed"
         UNKNOWN = "unknown"
 
-    def __init__(self, kind: Kind, payload: Union[str, BuildStatus]):
+    def __init__(self, kind: Kind, payload: Union[dict, BuildStatus]):
         self.kind = kind
         self.payload = payload
 
@@ -145,6 +154,14 @@ class BuildExecutor(LoggingConfigurable):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.main_loop = IOLoop.current()
+        self._main_thread = threading.get_ident()
+        # with a bounded queue, build threads wait for a slot before queueing
+        # an event, slots are released by get_progress()
+        self._progress_slots = None
+        if isinstance(self.q, Queue) and self.q.maxsize:
+            self._progress_slots = threading.BoundedSemaphore(self.q.maxsize)
+        # events queued from the main thread, which can't wait for a slot
+        self._unslotted_events = 0
 
     stop_event = Any()
 
@@ -190,11 +207,48 @@ class BuildExecutor(LoggingConfigurable):
 
         return cmd
 
-    def progress(self, kind: ProgressEvent.Kind, payload: str):
+    def progress(
+        self,
+        kind: ProgressEvent.Kind,
+        payload: Union[dict, str, ProgressEvent.BuildStatus],
+    ):
         """
         Put current progress info into the queue on the main thread
+
+        When called from a build thread and the queue is bounded, this waits while
+        the queue is full, so a slow client slows down the producer instead of
+        buffering events without limit. Waiting ends early if the build is stopped.
+
+        The payload of LOG_MESSAGE events is a dict, JSON strings are decoded.
         """
-        self.main_loop.add_callback(self.q.put, ProgressEvent(kind, payload))
+        if kind == ProgressEvent.Kind.LOG_MESSAGE and isinstance(payload, str):
+            # log messages used to be passed as JSON strings
+            payload = json_loads(payload)
+        event = ProgressEvent(kind, payload)
+        if self._progress_slots is not None:
+            if threading.get_ident() == self._main_thread:
+                # can't wait for the consumer on the main thread
+                self._unslotted_events += 1
+            else:
+                while not self._progress_slots.acquire(timeout=1):
+                    if self.stop_event.is_set():
+                        return
+        self.main_loop.add_callback(self.q.put, event)
+
+    async def get_progress(self):
+        """
+        Get the next progress event from the queue
+
+        Consumers should use this rather than `q.get()`,
+        so that build threads waiting for space in the queue can continue.
+        """
+        event = await self.q.get()
+        if self._progress_slots is not None:
+            if self._unslotted_events:
+                self._unslotted_events -= 1
+            else:
+                self._progress_slots.release()
+        return event
 
     def submit(self):
         """
@@ -668,10 +722,11 @@ class KubernetesBuildExecutor(BuildExecutor):
             if self.stop_event.is_set():
                 app_log.info("Stopping logs of %s", self.name)
                 return
-            # verify that the line is JSON
+            # the line should be JSON, the decoded event is passed on
+            # and only serialized again when it is sent to the client
             line = line.decode("utf-8")
             try:
-                json.loads(line)
+                event = json_loads(line)
             except ValueError:
                 # log event wasn't JSON.
                 # use the line itself as the message with unknown phase.
@@ -679,14 +734,12 @@ class KubernetesBuildExecutor(BuildExecutor):
                 # If it was a fatal error, presumably a 'failure'
                 # message will arrive shortly.
                 app_log.error("log event not json: %r", line)
-                line = json.dumps(
-                    {
-                        "phase": "unknown",
-                        "message": line,
-                    }
-                )
+                event = {
+                    "phase": "unknown",
+                    "message": line,
+                }
 
-            self.progress(ProgressEvent.Kind.LOG_MESSAGE, line)
+            self.progress(ProgressEvent.Kind.LOG_MESSAGE, event)
         else:
             app_log.info("Finished streaming logs of %s", self.name)
 
@@ -818,12 +871,10 @@ class FakeBuild(BuildExecutor):
                 return
             self.progress(
                 ProgressEvent.Kind.LOG_MESSAGE,
-                json.dumps(
-                    {
-                        "phase": phase,
-                        "message": f"{phase}...\n",
-                    }
-                ),
+                {
+                    "phase": phase,
+                    "message": f"{phase}...\n",
+                },
             )
         for i in range(5):
             if self.stop_event.is_set():
@@ -832,22 +883,18 @@ class FakeBuild(BuildExecutor):
             time.sleep(1)
             self.progress(
                 "log",
-                json.dumps(
-                    {
-                        "phase": "unknown",
-                        "message": f"Step {i+1}/10\n",
-                    }
-                ),
+                {
+                    "phase": "unknown",
+                    "message": f"Step {i+1}/10\n",
+                },
             )
         self.progress(
             ProgressEvent.Kind.BUILD_STATUS_CHANGE, ProgressEvent.BuildStatus.BUILT
         )
         self.progress(
             "log",
-            json.dumps(
-                {
-                    "phase": "Deleted",
-                    "message": "Deleted...\n",
-                }
-            ),
+            {
+                "phase": "Deleted",
+                "message": "Deleted...\n",
+            },
         )
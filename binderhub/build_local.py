@@ -2,7 +2,6 @@
 Contains build of a docker image from a git repository.
 """
 
-import json
 import os
 
 # These methods are synchronous so don't use tornado.queue
@@ -14,6 +13,7 @@ from tornado.log import app_log
 from traitlets import default
 
 from .build import BuildExecutor, ProgressEvent
+from .utils import json_loads
 
 DEFAULT_READ_TIMEOUT = 1
 
@@ -163,7 +163,7 @@ class LocalRepo2dockerBuild(BuildExecutor):
 
     def _handle_log(self, line):
         try:
-            json.loads(line)
+            event = json_loads(line)
         except ValueError:
             # log event wasn't JSON.
             # use the line itself as the message with unknown phase.
@@ -171,10 +171,8 @@ class LocalRepo2dockerBuild(BuildExecutor):
             # If it was a fatal error, presumably a 'failure'
             # message will arrive shortly.
             app_log.error("log event not json: %r", line)
-            line = json.dumps(
-                {
-                    "phase": "unknown",
-                    "message": line,
-                }
-            )
-        self.progress(ProgressEvent.Kind.LOG_MESSAGE, line)
+            event = {
+                "phase": "unknown",
+                "message": line,
+            }
+        self.progress(ProgressEvent.Kind.LOG_MESSAGE, event)
@@ -3,7 +3,7 @@ Handlers for working with version control services (i.e. GitHub) for builds.
 """
 
 import asyncio
-import hashlib
+import functools
 import json
 import re
 import string
@@ -12,6 +12,7 @@ from http.client import responses
 
 import docker
 import escapism
+import xxhash
 from prometheus_client import Counter, Gauge, Histogram
 from tornado import gen
 from tornado.httpclient import HTTPClientError
@@ -25,6 +26,7 @@ from .base import BaseHandler
 from .repoauth import TokenStore
 from .build import ProgressEvent
 from .quota import LaunchQuotaExceeded
+from .utils import Cache, json_dumps_bytes
 
 # Separate buckets for builds and launches.
 # Builds and launches have very different characteristic times,
@@ -53,10 +55,32 @@ LAUNCH_COUNT = Counter(
     "Counter of launches by repo",
     ["status", "provider", "repo"],
 )
-BUILDS_INPROGRESS = Gauge("binderhub_inprogress_builds", "Builds currently in progress")
+# in multiprocess mode, in-progress counts are summed over processes
+# that have not been marked dead (see metrics.mark_process_dead)
+BUILDS_INPROGRESS = Gauge(
+    "binderhub_inprogress_builds",
+    "Builds currently in progress",
+    multiprocess_mode="livesum",
+)
 LAUNCHES_INPROGRESS = Gauge(
-    "binderhub_inprogress_launches", "Launches currently in progress"
+    "binderhub_inprogress_launches",
+    "Launches currently in progress",
+    multiprocess_mode="livesum",
 )
+# label lookups for metrics with fixed labels are done once,
+# not on every observation
+BUILD_TIME_SUCCESS = BUILD_TIME.labels(status="success")
+BUILD_TIME_FAILURE = BUILD_TIME.labels(status="failure")
+
+# The hash used to make build slugs unique.
+# Changing it changes every image name, invalidating all cached images.
+SLUG_HASH_VERSION = "xxh3"
+
+# characters that are never escaped in build slugs
+SAFE_SLUG_CHARS = frozenset(string.ascii_letters + string.digits)
+# str.translate table escaping ascii characters
+# exactly like escapism.escape(s, safe=SAFE_SLUG_CHARS, escape_char="-")
+_SLUG_ESCAPE_TABLE = {i: f"-{i:X}" for i in range(128) if chr(i) not in SAFE_SLUG_CHARS}
 
 
 def _get_image_basename_and_tag(full_name):
@@ -102,20 +126,47 @@ def _generate_build_name(build_slug, ref, prefix="", limit=63, ref_length=6):
     We also ensure that the returned value is DNS safe, by only using
     ascii lowercase + digits. everything else is escaped
     """
+    escaped_slug, slug_hash = _escape_and_hash(build_slug)
+    return _build_name(escaped_slug, slug_hash, ref, prefix, limit, ref_length)
+
+
+def _build_name(escaped_slug, slug_hash, ref, prefix="", limit=63, ref_length=6):
+    """Format a build name from the result of _escape_and_hash(build_slug)
+
+    See _generate_build_name
+    """
     # escape parts that came from providers (build slug, ref)
     # build names are case-insensitive `.lower()` is called at the end
-    build_slug = _safe_build_slug(
-        build_slug, limit=limit - len(prefix) - ref_length - 1
+    safe_slug = _image_slug(
+        escaped_slug, slug_hash, limit=limit - len(prefix) - ref_length - 1
     )
     ref = _safe_build_slug(ref, limit=ref_length, hash_length=2)
 
     return "{prefix}{safe_slug}-{ref}".format(
         prefix=prefix,
-        safe_slug=build_slug,
+        safe_slug=safe_slug,
         ref=ref[:ref_length],
     ).lower()
 
 
+# _build_name with the arguments used for build pods
+# (prefix="build-", limit=63, ref_length=6), with the lengths computed once:
+# 63 - len("build-") - 6 (ref) - 1 (separator) = 50 characters for the slug,
+# of which 6 are the hash and 1 is a separator.
+_BUILD_SLUG_NAME_LENGTH = 63 - len("build-") - 6 - 1 - 6 - 1
+# the escaped ref is truncated to 6 - 2 (hash) - 1 (separator) characters
+_BUILD_REF_NAME_LENGTH = 6 - 2 - 1
+
+
+def _build_pod_name(escaped_slug, slug_hash, ref):
+    """Format the name of a build pod, same as _build_name(..., prefix="build-")"""
+    escaped_ref, ref_hash = _escape_and_hash(ref)
+    return (
+        f"build-{escaped_slug[:_BUILD_SLUG_NAME_LENGTH]}-{slug_hash[:6]}"
+        f"-{escaped_ref[:_BUILD_REF_NAME_LENGTH]}-{ref_hash[:2]}"
+    ).lower()
+
+
 def _safe_build_slug(build_slug, limit, hash_length=6):
     """Create a unique-ish name from a slug.
 
@@ -129,64 +180,189 @@ def _safe_build_slug(build_slug, limit, hash_length=6):
     Since this changes the image name generation scheme, all existing cached
     images will be invalidated.
     """
-    build_slug_hash = hashlib.sha256(build_slug.encode("utf-8")).hexdigest()
-    safe_chars = set(string.ascii_letters + string.digits)
+    escaped_slug, slug_hash = _escape_and_hash(build_slug)
+    return _image_slug(escaped_slug, slug_hash, limit, hash_length)
+
 
-    def escape(s):
-        return escapism.escape(s, safe=safe_chars, escape_char="-")
+@functools.lru_cache(maxsize=4096)
+def _escape_and_hash(build_slug):
+    """Escape a slug and hash it, the expensive part of _safe_build_slug
 
-    build_slug = escape(build_slug)
+    Returns (escaped_slug, hex_hash), which only need slicing to produce
+    safe names of any length, so a slug is only processed once per request.
+
+    The hash is only used as a short uniqueness tag, so a fast non-cryptographic
+    hash is used (see SLUG_HASH_VERSION).
+    """
+    return (
+        _escape_slug(build_slug),
+        xxhash.xxh3_64(build_slug.encode("utf-8")).hexdigest(),
+    )
+
+
+def _escape_slug(s):
+    """Escape all characters except ascii letters and digits in a slug"""
+    if s.isascii():
+        # the common case, escaped with a single pass in C
+        return s.translate(_SLUG_ESCAPE_TABLE)
+    return escapism.escape(s, safe=set(SAFE_SLUG_CHARS), escape_char="-")
+
+
+def _image_slug(escaped_slug, slug_hash, limit, hash_length=6):
+    """Format a safe slug from the result of _escape_and_hash(build_slug)
+
+    See _safe_build_slug
+    """
     return "{name}-{hash}".format(
-        name=build_slug[: limit - hash_length - 1],
-        hash=build_slug_hash[:hash_length],
+        name=escaped_slug[: limit - hash_length - 1],
+        hash=slug_hash[:hash_length],
     ).lower()
 
 
+# Slugs are escaped and hashed once, repeated launches of the same repo
+# are served from the cache.
+SLUG_CACHE = Gauge(
+    "binderhub_slug_cache_lookups",
+    "Lookups in the build slug caches",
+    ["function", "result"],
+)
+for _result in ("hits", "misses"):
+    SLUG_CACHE.labels(function=_escape_and_hash.__name__, result=_result).set_function(
+        lambda r=_result: getattr(_escape_and_hash.cache_info(), r)
+    )
+del _result
+
+
+def keep_alive_build_handlers(handlers):
+    """Emit keepalive events on all open build event streams
+
+    Called periodically by the application,
+    so there is one timer for all handlers instead of one per request.
+    """
+    for handler in list(handlers):
+        try:
+            handler.send_keepalive()
+        except Exception:
+            # don't skip the remaining handlers
+            app_log.exception("Error sending keepalive for %s", handler.request.uri)
+
+
 class BuildHandler(BaseHandler):
     """A handler for working with GitHub."""
 
     # emit keepalives every 25 seconds to avoid idle connections being closed
     KEEPALIVE_INTERVAL = 25
+    # events are written as they are emitted, but only flushed to the client
+    # once this many bytes are pending, or after EMIT_FLUSH_DELAY seconds,
+    # to avoid one flush per log line when streaming verbose build logs
+    EMIT_BUFFER_SIZE = 16384
+    EMIT_FLUSH_DELAY = 0.05
+    # maximum number of progress events waiting to be emitted,
+    # build threads wait for space when the client is slow to read.
+    # Large enough to absorb bursts of build log lines.
+    PROGRESS_QUEUE_SIZE = 1024
     build = None
 
+    # shared caches for image manifest lookups in the registry.
+    # Built images are stable, but missing images may be built at any time,
+    # so those results expire sooner.
+    _manifest_cache = Cache(10000, max_age=60)
+    _manifest_404_cache = Cache(10000, max_age=5)
+    # image name: in-progress lookup
+    _manifest_lookups = {}
+
+    _emit_pending = 0
+    _emit_flush_handle = None
+    _stream_closed = False
+
     async def emit(self, data):
-        """Emit an eventstream event"""
+        """Emit an eventstream event
+
+        The event is written to the response buffer immediately,
+        flushing is batched (see EMIT_BUFFER_SIZE and EMIT_FLUSH_DELAY).
+        """
+        if self._stream_closed:
+            raise Finish()
         if type(data) is not str:
-            serialized_data = json.dumps(data)
+            serialized_data = json_dumps_bytes(data)
         else:
-            serialized_data = data
+            serialized_data = data.encode("utf8")
+        chunk = b"data: " + serialized_data + b"\n\n"
+        self.write(chunk)
+        self._emit_pending += len(chunk)
+        if self._emit_pending >= self.EMIT_BUFFER_SIZE:
+            await self._flush_events()
+        elif self._emit_flush_handle is None:
+            self._emit_flush_handle = IOLoop.current().call_later(
+                self.EMIT_FLUSH_DELAY, self._delayed_flush
+            )
+
+    async def _flush_events(self):
+        """Flush all pending events to the client"""
+        if self._emit_flush_handle is not None:
+            IOLoop.current().remove_timeout(self._emit_flush_handle)
+            self._emit_flush_handle = None
+        self._emit_pending = 0
         try:
-            self.write(f"data: {serialized_data}\n\n")
             await self.flush()
         except StreamClosedError:
             app_log.warning("Stream closed while handling %s", self.request.uri)
+            self._stream_closed = True
             # raise Finish to halt the handler
             raise Finish()
 
+    async def _delayed_flush(self):
+        """Flush pending events after EMIT_FLUSH_DELAY has passed"""
+        self._emit_flush_handle = None
+        if self._finished:
+            return
+        try:
+            await self._flush_events()
+        except Finish:
+            # the stream is closed, the next emit will halt the handler
+            pass
+
     def on_finish(self):
         """Stop keepalive when finish has been called"""
-        self._keepalive = False
+        self._stop_keepalive()
+        if self._emit_flush_handle is not None:
+            # finish() has already flushed everything
+            IOLoop.current().remove_timeout(self._emit_flush_handle)
+            self._emit_flush_handle = None
         if self.build:
             # if we have a build, tell it to stop watching
             self.build.stop()
 
-    async def keep_alive(self):
-        """Constantly emit keepalive events
+    def on_connection_close(self):
+        """Stop waiting for the client to close the connection"""
+        super().on_connection_close()
+        self._client_closed.set()
+
+    def _start_keepalive(self):
+        """Register for keepalive events, sent by keep_alive_build_handlers"""
+        self.settings["build_handlers"].add(self)
+
+    def _stop_keepalive(self):
+        self.settings["build_handlers"].discard(self)
+
+    def send_keepalive(self):
+        """Emit a keepalive event
 
         So that intermediate proxies don't terminate an idle connection
         """
-        self._keepalive = True
-        while True:
-            await gen.sleep(self.KEEPALIVE_INTERVAL)
-            if not self._keepalive:
-                return
-            try:
-                # lines that start with : are comments
-                # and should be ignored by event consumers
-                self.write(":keepalive\n\n")
-                await self.flush()
-            except StreamClosedError:
-                return
+        if self._finished or self._stream_closed:
+            return
+        # lines that start with : are comments
+        # and should be ignored by event consumers
+        self.write(":keepalive\n\n")
+        # this also flushes any pending events
+        self._emit_pending = 0
+        self.flush().add_done_callback(self._keepalive_flushed)
+
+    def _keepalive_flushed(self, f):
+        if not f.cancelled() and isinstance(f.exception(), StreamClosedError):
+            self._stream_closed = True
+            self._stop_keepalive()
 
     def send_error(self, status_code, **kwargs):
         """event stream cannot set an error code, so send an error event"""
@@ -205,9 +381,60 @@ class BuildHandler(BaseHandler):
                 "message": message + "\n",
             }
         )
+        self._stop_keepalive()
         self.write(f"data: {evt}\n\n")
         self.finish()
 
+    async def image_in_registry(self, image_name):
+        """Check whether an image exists in the registry
+
+        Results are cached for a short time,
+        and concurrent checks for the same image share a single lookup.
+        """
+        if self._manifest_cache.get(image_name):
+            return True
+        if self._manifest_404_cache.get(image_name):
+            return False
+        lookup = self._manifest_lookups.get(image_name)
+        if lookup is None:
+            lookup = asyncio.ensure_future(self._lookup_image_manifest(image_name))
+            self._manifest_lookups[image_name] = lookup
+            lookup.add_done_callback(
+                lambda f: self._manifest_lookups.pop(image_name, None)
+            )
+        # shield the shared lookup from cancellation of this request
+        return await asyncio.shield(lookup)
+
+    def _image_built(self, image_name):
+        """Record that this process has built and pushed an image
+
+        so the next request doesn't find a cached miss and build it again
+        """
+        if image_name in self._manifest_404_cache:
+            self._manifest_404_cache.pop(image_name)
+        self._manifest_cache.set(image_name, True)
+
+    async def _lookup_image_manifest(self, image_name):
+        image_without_tag, image_tag = _get_image_basename_and_tag(image_name)
+        for _ in range(3):
+            try:
+                image_manifest = await self.registry.get_image_manifest(
+                    image_without_tag, image_tag
+                )
+            except HTTPClientError:
+                app_log.exception(
+                    "Failed to get image manifest for %s",
+                    image_name,
+                )
+            else:
+                if image_manifest:
+                    self._manifest_cache.set(image_name, True)
+                    return True
+                self._manifest_404_cache.set(image_name, True)
+                return False
+        # don't cache errors
+        return False
+
     def initialize(self, binderhub_url=None):
         super().initialize()
         if self.settings["use_registry"]:
@@ -216,8 +443,10 @@ class BuildHandler(BaseHandler):
         self.event_log = self.settings['event_log']
         self.binderhub_url = binderhub_url
         self.tokenstore = TokenStore(self.settings['repo_token_store'])
+        self._client_closed = asyncio.Event()
 
     async def fail(self, message):
+        self._stop_keepalive()
         await self.emit(
             {
                 "phase": "failed",
@@ -285,9 +514,6 @@ class BuildHandler(BaseHandler):
             await self.fail(f"No provider found for prefix {provider_prefix}")
             return
 
-        # create a heartbeat
-        IOLoop.current().spawn_callback(self.keep_alive)
-
         spec = spec.rstrip("/")
         key = f"{provider_prefix}:{spec}"
 
@@ -412,37 +638,34 @@ class BuildHandler(BaseHandler):
                 await self.fail(" ".join(error_message))
                 return
 
+        # create a heartbeat, now that the request is not going to fail fast
+        self._start_keepalive()
+
         self.ref_url = await provider.get_resolved_ref_url()
         resolved_spec = await provider.get_resolved_spec()
 
         badge_base_url = self.get_badge_base_url()
-        self.binder_launch_host = badge_base_url or "{proto}://{host}{base_url}".format(
-            proto=self.request.protocol,
-            host=self.request.host,
-            base_url=self.settings["base_url"],
+        self.binder_launch_host = (
+            badge_base_url
+            or f"{self.request.protocol}://{self.request.host}{self.settings['base_url']}"
         )
         # These are relative URLs so do not have a leading /
-        self.binder_request = "v2/{provider}/{spec}".format(
-            provider=provider_prefix,
-            spec=spec,
-        )
-        self.binder_persistent_request = "v2/{provider}/{spec}".format(
-            provider=provider_prefix,
-            spec=resolved_spec,
-        )
+        self.binder_request = f"v2/{provider_prefix}/{spec}"
+        self.binder_persistent_request = f"v2/{provider_prefix}/{resolved_spec}"
 
         # generate a complete build name (for GitHub: `build-{user}-{repo}-{ref}`)
 
         image_prefix = self.settings["image_prefix"]
 
+        # the image and build names share the escaped slug and its hash
+        escaped_slug, slug_hash = _escape_and_hash(provider.get_build_slug())
+
         # Enforces max 255 characters before image
-        safe_build_slug = _safe_build_slug(
-            provider.get_build_slug(), limit=255 - len(image_prefix)
+        safe_build_slug = _image_slug(
+            escaped_slug, slug_hash, limit=255 - len(image_prefix)
         )
 
-        build_name = _generate_build_name(
-            provider.get_build_slug(), ref, prefix="build-"
-        )
+        build_name = _build_pod_name(escaped_slug, slug_hash, ref)
 
         image_name = self.image_name = (
             "{prefix}{build_slug}:{ref}".format(
@@ -454,25 +677,24 @@ class BuildHandler(BaseHandler):
 
         image_without_tag, image_tag = _get_image_basename_and_tag(image_name)
         if self.settings["use_registry"]:
-            for _ in range(3):
-                try:
-                    image_manifest = await self.registry.get_image_manifest(
-                        image_without_tag, image_tag
-                    )
-                    image_found = bool(image_manifest)
-                    break
-                except HTTPClientError:
-                    app_log.exception(
-                        "Failed to get image manifest for %s",
-                        image_name,
-                    )
-                    image_found = False
+            image_found = await self.image_in_registry(image_name)
         else:
             # Check if the image exists locally!
             # Assume we're running in single-node mode or all binder pods are assigned to the same node!
-            docker_client = docker.from_env(version="auto")
+            docker_client = self.settings["docker_client"]
+            if docker_client is None:
+                # created on first use rather than at startup,
+                # so BinderHub can start while the docker daemon is unreachable
+                docker_client = await asyncio.wrap_future(
+                    self.settings["executor"].submit(docker.from_env, version="auto")
+                )
+                self.settings["docker_client"] = docker_client
             try:
-                docker_client.images.get(image_name)
+                await asyncio.wrap_future(
+                    self.settings["executor"].submit(
+                        docker_client.images.get, image_name
+                    )
+                )
             except docker.errors.ImageNotFound:
                 # image doesn't exist, so do a build!
                 image_found = False
@@ -527,7 +749,7 @@ class BuildHandler(BaseHandler):
             return
 
         # Prepare to build
-        q = Queue()
+        q = Queue(maxsize=self.PROGRESS_QUEUE_SIZE)
 
         BuildClass = self.settings.get("build_class")
 
@@ -558,23 +780,24 @@ class BuildHandler(BaseHandler):
             failed = False
 
             def _check_result(future):
-                nonlocal done
-                nonlocal failed
                 try:
                     r = future.result()
                     app_log.debug("task completed: %s", r)
-                except Exception:
+                except Exception as e:
                     app_log.error("task failed", exc_info=True)
-                    done = True
-                    failed = True
-                    # TODO: Propagate error to front-end
+                    # queued after any pending events,
+                    # the progress loop sends it to the client and stops
+                    build.progress(
+                        ProgressEvent.Kind.BUILD_ERROR,
+                        {"phase": "failed", "message": f"{e}\n"},
+                    )
 
             build_starttime = time.perf_counter()
             pool = self.settings["build_pool"]
-            # Start building
-            submit_future = pool.submit(build.submit)
+            # Start building,
+            # wrapped so that _check_result is called on the event loop
+            submit_future = asyncio.wrap_future(pool.submit(build.submit))
             submit_future.add_done_callback(_check_result)
-            IOLoop.current().add_callback(lambda: submit_future)
 
             log_future = None
 
@@ -587,7 +810,7 @@ class BuildHandler(BaseHandler):
             )
 
             while not done:
-                progress = await q.get()
+                progress = await build.get_progress()
                 # FIXME: If pod goes into an unrecoverable stage, such as ImagePullBackoff or
                 # whatever, we should fail properly.
                 if progress.kind == ProgressEvent.Kind.BUILD_STATUS_CHANGE:
@@ -606,17 +829,19 @@ class BuildHandler(BaseHandler):
                             "message": message,
                             "imageName": image_name,
                         }
-                        BUILD_TIME.labels(status="success").observe(
+                        BUILD_TIME_SUCCESS.observe(
                             time.perf_counter() - build_starttime
                         )
-                        BUILD_COUNT.labels(
-                            status="success", **self.repo_metric_labels
-                        ).inc()
+                        self._build_count_success.inc()
+                        if self.settings["use_registry"]:
+                            self._image_built(image_name)
                         done = True
                     elif progress.payload == ProgressEvent.BuildStatus.RUNNING:
                         # start capturing build logs once the pod is running
                         if log_future is None:
-                            log_future = pool.submit(build.stream_logs)
+                            log_future = asyncio.wrap_future(
+                                pool.submit(build.stream_logs)
+                            )
                             log_future.add_done_callback(_check_result)
                         continue
                     elif progress.payload == ProgressEvent.BuildStatus.BUILT:
@@ -631,18 +856,25 @@ class BuildHandler(BaseHandler):
                             f"Found unknown phase {phase} in ProgressEvent"
                         )
                 elif progress.kind == ProgressEvent.Kind.LOG_MESSAGE:
-                    # The logs are coming out of repo2docker, so we expect
-                    # them to be JSON structured anyway
+                    # The logs are coming out of repo2docker as JSON,
+                    # already decoded by the build executor
                     event = progress.payload
-                    payload = json.loads(event)
-                    if payload.get("phase") in ("failure", "failed"):
+                    if event.get("phase") in ("failure", "failed"):
                         failed = True
-                        BUILD_TIME.labels(status="failure").observe(
+                        BUILD_TIME_FAILURE.observe(
                             time.perf_counter() - build_starttime
                         )
-                        BUILD_COUNT.labels(
-                            status="failure", **self.repo_metric_labels
-                        ).inc()
+                        self._build_count_failure.inc()
+                elif progress.kind == ProgressEvent.Kind.BUILD_ERROR:
+                    event = progress.payload
+                    if not failed:
+                        # not already counted from the build logs
+                        failed = True
+                        BUILD_TIME_FAILURE.observe(
+                            time.perf_counter() - build_starttime
+                        )
+                        self._build_count_failure.inc()
+                    done = True
                 await self.emit(event)
 
         if build_only:
@@ -673,11 +905,25 @@ class BuildHandler(BaseHandler):
         # (javascript) eventstream clients reconnect automatically on dropped connections,
         # so if the server closes the connection first,
         # the client will reconnect which starts a new build.
-        # If we sleep here, that makes it more likely that a well-behaved
+        # If we wait here, that makes it more likely that a well-behaved
         # client will close its connection first.
         # The duration of this shouldn't matter because
-        # well-behaved clients will close connections after they receive the launch event.
-        await gen.sleep(60)
+        # well-behaved clients will close connections after they receive the launch event,
+        # which ends the wait.
+        try:
+            await asyncio.wait_for(self._client_closed.wait(), timeout=60)
+        except asyncio.TimeoutError:
+            pass
+
+    # per-repo metrics are bound on first use,
+    # after repo_metric_labels has been set in get()
+    @functools.cached_property
+    def _build_count_success(self):
+        return BUILD_COUNT.labels(status="success", **self.repo_metric_labels)
+
+    @functools.cached_property
+    def _build_count_failure(self):
+        return BUILD_COUNT.labels(status="failure", **self.repo_metric_labels)
 
     async def check_quota(self, provider):
         """Check quota before proceeding with build/launch
@@ -711,16 +957,17 @@ class BuildHandler(BaseHandler):
         quota_check = await self.check_quota(provider)
 
         if quota_check:
-            if quota_check.matching >= 0.5 * quota_check.quota:
+            if quota_check.quota and quota_check.matching >= 0.5 * quota_check.quota:
                 log = app_log.warning
             else:
                 log = app_log.info
-            log(
-                "Launching server for %s: %s other servers running this repo (%s total)",
-                self.repo_url,
-                quota_check.matching,
-                quota_check.total,
-            )
+            # only servers that are limited by a quota are counted
+            counts = []
+            if quota_check.matching is not None:
+                counts.append(f"{quota_check.matching} other servers running this repo")
+            if quota_check.total is not None:
+                counts.append(f"{quota_check.total} total")
+            log("Launching server for %s: %s", self.repo_url, ", ".join(counts))
 
         await self.emit(
             {
@@ -729,6 +976,29 @@ class BuildHandler(BaseHandler):
             }
         )
 
+        async def handle_progress_event(event):
+            message = event["message"]
+            await self.emit(
+                {
+                    "phase": "launching",
+                    "message": message + "\n",
+                }
+            )
+
+        # the request doesn't change between attempts
+        extra_args = {
+            "binder_ref_url": self.ref_url,
+            "binder_launch_host": self.binder_launch_host,
+            "binder_request": self.binder_request,
+            "binder_persistent_request": self.binder_persistent_request,
+        }
+        extra_args['repo_token'] = self.repo_token
+        for key, values in self.request.query_arguments.items():
+            if not key.startswith('useropt.'):
+                continue
+            app_log.debug('extra_args: {}={}'.format(key, values))
+            extra_args[key[8:]] = '\t'.join([v.decode('utf8') for v in values])
+
         launcher = self.settings["launcher"]
         retry_delay = launcher.retry_delay
         for i in range(launcher.retries):
@@ -749,28 +1019,6 @@ class BuildHandler(BaseHandler):
                 username = launcher.unique_name_from_repo(self.repo_url)
                 server_name = ""
             try:
-
-                async def handle_progress_event(event):
-                    message = event["message"]
-                    await self.emit(
-                        {
-                            "phase": "launching",
-                            "message": message + "\n",
-                        }
-                    )
-
-                extra_args = {
-                    "binder_ref_url": self.ref_url,
-                    "binder_launch_host": self.binder_launch_host,
-                    "binder_request": self.binder_request,
-                    "binder_persistent_request": self.binder_persistent_request,
-                }
-                extra_args['repo_token'] = self.repo_token
-                for key, values in self.request.query_arguments.items():
-                    if not key.startswith('useropt.'):
-                        continue
-                    app_log.debug('extra_args: {}={}'.format(key, values))
-                    extra_args[key[8:]] = '\t'.join([v.decode('utf8') for v in values])
                 server_info = await launcher.launch(
                     image=self.image_name,
                     username=username,
@@ -1,12 +1,44 @@
-from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+)
 
 from .base import BaseHandler
 
 
+def metrics_registry():
+    """The registry to expose on /metrics
+
+    When running multiple processes with PROMETHEUS_MULTIPROC_DIR set,
+    each process writes its metrics to its own files in that directory
+    and they are aggregated at scrape time.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def mark_process_dead(pid=None):
+    """Remove the live gauge values of a stopped process
+
+    Only needed when running multiple processes with PROMETHEUS_MULTIPROC_DIR set,
+    otherwise the values of in-progress gauges are kept after the process is gone.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(pid or os.getpid())
+
+
 class MetricsHandler(BaseHandler):
     # demote logging of 200 responses to debug-level
     log_success_debug = True
 
     async def get(self):
         self.set_header("Content-Type", CONTENT_TYPE_LATEST)
-        self.write(generate_latest(REGISTRY))
+        self.write(generate_latest(metrics_registry()))
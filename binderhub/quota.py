@@ -3,16 +3,18 @@ Singleuser server quotas
 """
 
 import asyncio
-import json
 import os
-from collections import namedtuple
+import threading
+import time
+from collections import Counter, namedtuple
 
 import kubernetes.config
-from kubernetes import client
-from traitlets import Any, Integer, Unicode, default
+from kubernetes import client, watch
+from traitlets import Any, Bool, Integer, Unicode, default
 from traitlets.config import LoggingConfigurable
 
-from .utils import KUBE_REQUEST_TIMEOUT
+from .binderspawner_mixin import REPO_HASH_LABEL, repo_hash_label_value
+from .utils import KUBE_REQUEST_TIMEOUT, json_loads
 
 
 class LaunchQuotaExceeded(Exception):
@@ -34,6 +36,8 @@ class LaunchQuotaExceeded(Exception):
 
 ServerQuotaCheck = namedtuple("ServerQuotaCheck", ["total", "matching", "quota"])
 
+SINGLEUSER_SELECTOR = "app=jupyterhub,component=singleuser-server"
+
 
 class LaunchQuota(LoggingConfigurable):
     executor = Any(
@@ -53,6 +57,14 @@ class LaunchQuota(LoggingConfigurable):
         config=True,
     )
 
+    def start(self):
+        """Start any background tasks needed to check quotas"""
+        pass
+
+    def stop(self):
+        """Stop any background tasks started by start()"""
+        pass
+
     async def check_repo_quota(self, image_name, repo_config, repo_url):
         """
         Check whether launching a repository would exceed a quota.
@@ -68,8 +80,8 @@ class LaunchQuota(LoggingConfigurable):
         If quotas are disabled returns None
         If quotas are exceeded raises LaunchQuotaExceeded
         Otherwise returns:
-          - total servers
-          - matching servers running image_name
+          - total servers (None if not counted)
+          - matching servers running image_name (None if not counted)
           - quota
         """
         return None
@@ -94,63 +106,247 @@ class KubernetesLaunchQuota(LaunchQuota):
     def _default_namespace(self):
         return os.getenv("BUILD_NAMESPACE", "default")
 
-    async def check_repo_quota(self, image_name, repo_config, repo_url):
-        # the image name (without tag) is unique per repo
-        # use this to count the number of pods running with a given repo
-        # if we added annotations/labels with the repo name via KubeSpawner
-        # we could do this better
-        image_no_tag = image_name.rsplit(":", 1)[0]
+    watch_pods = Bool(
+        True,
+        help="""
+        Keep counts of running singleuser pods up to date with a kubernetes watch
+        in the background, instead of listing pods whenever a quota is checked.
 
-        # TODO: put busy users in a queue rather than fail?
-        # That would be hard to do without in-memory state.
-        repo_quota = repo_config.get("quota")
-        pod_quota = self.total_quota
+        The watch starts with the first launch that checks a quota,
+        and pods are listed as before until it is running.
+        """,
+        config=True,
+    )
 
-        # Fetch info on currently running users *only* if quotas are set
-        if pod_quota is not None or repo_quota:
-            matching_pods = 0
+    watch_retry_delay = Integer(
+        5,
+        help="""Minimum number of seconds between restarts of the pod watch
+
+        A watch that ran for longer is restarted immediately.
+        """,
+        config=True,
+    )
+
+    list_page_size = Integer(
+        500,
+        help="""Number of pods to request at a time when counting pods
+
+        Pods are counted one page at a time,
+        so the full pod list of a large namespace is never held in memory.
+        """,
+        config=True,
+    )
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # pod name: REPO_HASH_LABEL value of all singleuser pods,
+        # only valid while _synced is True
+        self._pods = {}
+        self._repo_counts = Counter()
+        self._synced = False
+        self._watch_enabled = False
+        self._watch_thread = None
+        self._watch = None
+        self._stop_event = threading.Event()
+
+    def start(self):
+        """Allow watching singleuser pods in a background thread
 
-            # TODO: run a watch to keep this up to date in the background
+        The watch only starts once a quota is checked,
+        so no pods are watched if no quotas are configured.
+        """
+        self._watch_enabled = self.watch_pods
+
+    def stop(self):
+        """Stop watching singleuser pods"""
+        self._watch_enabled = False
+        self._stop_event.set()
+        w = self._watch
+        if w is not None:
+            w.stop()
+
+    def _start_watch(self):
+        if not self._watch_enabled or self._watch_thread is not None:
+            return
+        self._watch_thread = threading.Thread(
+            target=self._watch_pods_forever, daemon=True
+        )
+        self._watch_thread.start()
+
+    def _set_pod(self, name, repo_hashes):
+        """Record the repos a pod is running, or that it stopped if None"""
+        for old_hash in self._pods.pop(name, ()):
+            self._repo_counts[old_hash] -= 1
+        if repo_hashes is not None:
+            self._pods[name] = repo_hashes
+            for repo_hash in repo_hashes:
+                self._repo_counts[repo_hash] += 1
+
+    @staticmethod
+    def _repo_hashes(labels, images):
+        """The REPO_HASH_LABEL values a pod counts towards
+
+        Pods without the label (e.g. started before it was added)
+        are matched by the images of their containers.
+        """
+        repo_hash = (labels or {}).get(REPO_HASH_LABEL)
+        if repo_hash:
+            return frozenset([repo_hash])
+        return frozenset(repo_hash_label_value(image) for image in images)
+
+    def _pod_repo_hashes(self, pod):
+        containers = pod.spec.containers if pod.spec else []
+        return self._repo_hashes(
+            pod.metadata.labels, (container.image for container in containers)
+        )
+
+    def _watch_pods_forever(self):
+        last_start = None
+        while not self._stop_event.is_set():
+            if last_start is not None:
+                # Restarting a watch that ran for a while is immediate,
+                # but don't list all pods in a tight loop if it keeps failing
+                delay = self.watch_retry_delay - (time.monotonic() - last_start)
+                if delay > 0 and self._stop_event.wait(delay):
+                    return
+            last_start = time.monotonic()
+            try:
+                self._watch_pods()
+            except client.rest.ApiException as e:
+                # 410 Gone means our resourceVersion is too old,
+                # start over with a fresh list
+                if e.status != 410:
+                    self.log.exception("Error watching singleuser pods")
+            except Exception:
+                self.log.exception("Error watching singleuser pods")
+            finally:
+                self._synced = False
+
+    def _watch_pods(self):
+        """List singleuser pods, then keep the counts up to date until an error"""
+        pod_list = self.api.list_namespaced_pod(
+            self.namespace,
+            label_selector=SINGLEUSER_SELECTOR,
+            _request_timeout=KUBE_REQUEST_TIMEOUT,
+        )
+        self._pods = {}
+        self._repo_counts = Counter()
+        for pod in pod_list.items:
+            self._set_pod(pod.metadata.name, self._pod_repo_hashes(pod))
+        resource_version = pod_list.metadata.resource_version
+        self._synced = True
+        self.log.debug("Watching %i singleuser pods", len(self._pods))
+
+        while not self._stop_event.is_set():
+            w = self._watch = watch.Watch()
+            if self._stop_event.is_set():
+                # stopped before stop() could see this watch
+                return
+            try:
+                for event in w.stream(
+                    self.api.list_namespaced_pod,
+                    self.namespace,
+                    label_selector=SINGLEUSER_SELECTOR,
+                    resource_version=resource_version,
+                    timeout_seconds=300,
+                    _request_timeout=(KUBE_REQUEST_TIMEOUT[0], 330),
+                ):
+                    if event["type"] == "ERROR":
+                        # e.g. 410 Gone, start over with a fresh list
+                        self.log.info("Restarting pod watch: %s", event["raw_object"])
+                        return
+                    pod = event["object"]
+                    resource_version = pod.metadata.resource_version
+                    if event["type"] == "DELETED":
+                        self._set_pod(pod.metadata.name, None)
+                    else:
+                        self._set_pod(pod.metadata.name, self._pod_repo_hashes(pod))
+            finally:
+                w.stop()
+                self._watch = None
+
+    async def _count_pods(self, label_selector, repo_hash=None):
+        """Count the singleuser pods matching a label selector
+
+        If repo_hash is given, only count pods running that repo
+        according to their container images.
+        """
+        count = 0
+        continue_token = None
+        while True:
             f = self.executor.submit(
                 self.api.list_namespaced_pod,
                 self.namespace,
-                label_selector="app=jupyterhub,component=singleuser-server",
+                label_selector=label_selector,
+                limit=self.list_page_size,
+                _continue=continue_token,
                 _request_timeout=KUBE_REQUEST_TIMEOUT,
                 _preload_content=False,
             )
             resp = await asyncio.wrap_future(f)
-            pods = json.loads(resp.read())["items"]
-            total_pods = len(pods)
-
-            if pod_quota is not None and total_pods >= pod_quota:
-                # check overall quota first
-                self.log.error(f"BinderHub is full: {total_pods}/{pod_quota}")
-                raise LaunchQuotaExceeded(
-                    "Too many users on this BinderHub! Try again soon.",
-                    quota=pod_quota,
-                    used=total_pods,
-                    status="pod_quota",
-                )
-
-            for pod in pods:
-                for container in pod["spec"]["containers"]:
-                    # is the container running the same image as us?
-                    # if so, count one for the current repo.
-                    image = container["image"].rsplit(":", 1)[0]
-                    if image == image_no_tag:
-                        matching_pods += 1
-                        break
-
-            if repo_quota and matching_pods >= repo_quota:
-                self.log.error(
-                    f"{repo_url} has exceeded quota: {matching_pods}/{repo_quota} ({total_pods} total)"
-                )
-                raise LaunchQuotaExceeded(
-                    f"Too many users running {repo_url}! Try again soon.",
-                    quota=repo_quota,
-                    used=matching_pods,
-                    status="repo_quota",
-                )
+            page = json_loads(resp.read())
+            if repo_hash is None:
+                count += len(page["items"])
+            else:
+                for pod in page["items"]:
+                    images = (c["image"] for c in pod["spec"]["containers"])
+                    if repo_hash in self._repo_hashes(None, images):
+                        count += 1
+            continue_token = page.get("metadata", {}).get("continue")
+            if not continue_token:
+                return count
+
+    async def check_repo_quota(self, image_name, repo_config, repo_url):
+        # TODO: put busy users in a queue rather than fail?
+        # That would be hard to do without in-memory state.
+        repo_quota = repo_config.get("quota")
+        pod_quota = self.total_quota
+
+        # Fetch info on currently running users *only* if quotas are set
+        if pod_quota is not None or repo_quota:
+            self._start_watch()
+            # BinderSpawner labels pods with a hash of the image name without
+            # the tag, which is unique per repo
+            repo_hash = repo_hash_label_value(image_name)
+            total_pods = None
+            matching_pods = None
+            if self._synced:
+                # counts are kept up to date by the pod watch
+                total_pods = len(self._pods)
+                matching_pods = self._repo_counts[repo_hash]
+
+            if pod_quota is not None:
+                if total_pods is None:
+                    total_pods = await self._count_pods(SINGLEUSER_SELECTOR)
+                if total_pods >= pod_quota:
+                    # check overall quota first
+                    self.log.error(f"BinderHub is full: {total_pods}/{pod_quota}")
+                    raise LaunchQuotaExceeded(
+                        "Too many users on this BinderHub! Try again soon.",
+                        quota=pod_quota,
+                        used=total_pods,
+                        status="pod_quota",
+                    )
+
+            if repo_quota:
+                if matching_pods is None:
+                    # only fetch the pods running this repo,
+                    # and pods without the label, which are matched by image
+                    matching_pods = await self._count_pods(
+                        f"{SINGLEUSER_SELECTOR},{REPO_HASH_LABEL}={repo_hash}"
+                    ) + await self._count_pods(
+                        f"{SINGLEUSER_SELECTOR},!{REPO_HASH_LABEL}", repo_hash
+                    )
+                if matching_pods >= repo_quota:
+                    self.log.error(
+                        f"{repo_url} has exceeded quota: {matching_pods}/{repo_quota} ({total_pods} total)"
+                    )
+                    raise LaunchQuotaExceeded(
+                        f"Too many users running {repo_url}! Try again soon.",
+                        quota=repo_quota,
+                        used=matching_pods,
+                        status="repo_quota",
+                    )
 
             return ServerQuotaCheck(
                 total=total_pods, matching=matching_pods, quota=repo_quota
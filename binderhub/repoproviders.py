@@ -33,7 +33,9 @@ from .utils import Cache
 from .repoauth import OAuth2Client
 
 GITHUB_RATE_LIMIT = Gauge(
-    "binderhub_github_rate_limit_remaining", "GitHub rate limit remaining"
+    "binderhub_github_rate_limit_remaining",
+    "GitHub rate limit remaining",
+    multiprocess_mode="mostrecent",
 )
 SHA1_PATTERN = re.compile(r"[0-9a-f]{40}")
 GIT_SSH_PATTERN = re.compile(r"([\w\-]+@[\w\-\.]+):(.+)", re.IGNORECASE)
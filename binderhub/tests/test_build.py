@@ -1,5 +1,6 @@
 """Test building repos"""
 
+import asyncio
 import json
 import sys
 from time import monotonic
@@ -176,6 +177,38 @@ async def test_build_fail(app, needs_build, needs_launch, always_build):
     assert failed_events > 0, "Should have seen phase 'failed'"
 
 
+class FailingSubmitBuild(BuildExecutor):
+    def submit(self):
+        raise RuntimeError("failed to submit build")
+
+
+@pytest.mark.timeout(120)
+async def test_build_submit_fail(app, needs_build, always_build):
+    """
+    Test that an error submitting the build is sent to the client.
+    """
+    slug = "gh/binderhub-ci-repos/cached-minimal-dockerfile/HEAD"
+    build_url = f"{app.url}/build/{slug}"
+    with mock.patch.dict(app.tornado_app.settings, {"build_class": FailingSubmitBuild}):
+        r = await async_requests.get(build_url, stream=True)
+        r.raise_for_status()
+        events = []
+        async for line in async_requests.iter_lines(r):
+            line = line.decode("utf8", "replace")
+            if line.startswith("data:"):
+                event = json.loads(line.split(":", 1)[1])
+                events.append(event)
+                assert event.get("phase") not in ("launching", "ready")
+                if event.get("phase") == "failed":
+                    break
+        r.close()
+
+    assert events[-1] == {
+        "phase": "failed",
+        "message": "failed to submit build\n",
+    }
+
+
 @pytest.mark.timeout(120)
 @pytest.mark.parametrize(
     "app,build_only_query_param,expected_error_msg",
@@ -620,6 +653,54 @@ async def test_local_repo2docker_build_stop(io_loop):
         docker_client.images.get(name)
 
 
+async def test_progress_waits_for_queue_space():
+    q = Queue(maxsize=2)
+    build = BuildExecutor(q=q)
+
+    def produce():
+        for i in range(5):
+            build.progress(ProgressEvent.Kind.LOG_MESSAGE, {"message": str(i)})
+
+    producer = asyncio.get_running_loop().run_in_executor(None, produce)
+    await asyncio.sleep(0.5)
+    # the producer is blocked on the full queue
+    assert q.qsize() == 2
+    assert not producer.done()
+
+    payloads = [(await build.get_progress()).payload for i in range(5)]
+    await producer
+    assert payloads == [{"message": str(i)} for i in range(5)]
+
+
+async def test_progress_from_main_thread():
+    q = Queue(maxsize=1)
+    build = BuildExecutor(q=q)
+
+    # events from the main thread are queued without waiting
+    build.progress(ProgressEvent.Kind.LOG_MESSAGE, {"message": "a"})
+    build.progress(ProgressEvent.Kind.LOG_MESSAGE, {"message": "b"})
+    for message in ("a", "b"):
+        assert (await build.get_progress()).payload == {"message": message}
+
+    # and don't take the slot of build threads
+    producer = asyncio.get_running_loop().run_in_executor(
+        None, build.progress, ProgressEvent.Kind.LOG_MESSAGE, {"message": "c"}
+    )
+    await asyncio.wait_for(producer, 5)
+    assert (await build.get_progress()).payload == {"message": "c"}
+
+
+async def test_progress_json_string():
+    q = Queue()
+    build = BuildExecutor(q=q)
+    build.progress(
+        ProgressEvent.Kind.LOG_MESSAGE,
+        json.dumps({"phase": "building", "message": "Step 1/10\n"}),
+    )
+    event = await build.get_progress()
+    assert event.payload == {"phase": "building", "message": "Step 1/10\n"}
+
+
 def test_execute_cmd():
     cmd = [
         "python",
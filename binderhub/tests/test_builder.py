@@ -1,6 +1,27 @@
+import asyncio
+import weakref
+from unittest import mock
+from uuid import uuid4
+
+import escapism
 import pytest
+from tornado.iostream import StreamClosedError
+from tornado.web import Finish
 
-from binderhub.builder import _generate_build_name, _get_image_basename_and_tag
+from binderhub.builder import (
+    SAFE_SLUG_CHARS,
+    BuildHandler,
+    _build_name,
+    _build_pod_name,
+    _escape_and_hash,
+    _escape_slug,
+    _generate_build_name,
+    _get_image_basename_and_tag,
+    _image_slug,
+    _safe_build_slug,
+    keep_alive_build_handlers,
+)
+from binderhub.utils import json_dumps_bytes
 
 
 @pytest.mark.parametrize(
@@ -56,3 +77,178 @@ def test_build_name(build_slug, ref):
 
     last_char = build_name[-1]
     assert last_char not in ("-", "_", ".")
+
+
+def test_safe_build_slug():
+    # the hash suffix is part of every image name,
+    # so changing it invalidates all cached images
+    slug = _safe_build_slug("binderhub-ci-repos/minimal-dockerfile", limit=40)
+    assert slug == "binderhub-2dci-2drepos-2fminimal--83f79a"
+    assert len(slug) <= 40
+
+
+def test_build_name_from_escaped_slug():
+    # BuildHandler escapes and hashes the build slug once,
+    # and derives both the image and build names from it
+    build_slug = "binderhub-ci-repos/minimal-dockerfile"
+    escaped_slug, slug_hash = _escape_and_hash(build_slug)
+    assert _image_slug(escaped_slug, slug_hash, limit=40) == _safe_build_slug(
+        build_slug, limit=40
+    )
+    assert _build_name(
+        escaped_slug, slug_hash, "abc123", prefix="build-"
+    ) == _generate_build_name(build_slug, "abc123", prefix="build-")
+
+
+def _emit_handler():
+    handler = BuildHandler.__new__(BuildHandler)
+    handler._finished = False
+    handler.request = mock.Mock(uri="/build/gh/test/repo/HEAD")
+    handler.write = mock.Mock()
+    handler.flush = mock.AsyncMock()
+    return handler
+
+
+async def test_emit_delayed_flush():
+    handler = _emit_handler()
+    await handler.emit({"phase": "waiting"})
+    handler.write.assert_called_once_with(
+        b"data: " + json_dumps_bytes({"phase": "waiting"}) + b"\n\n"
+    )
+    handler.flush.assert_not_called()
+
+    # flushed without further events
+    await asyncio.sleep(handler.EMIT_FLUSH_DELAY * 4)
+    handler.flush.assert_awaited_once()
+
+
+async def test_emit_buffer_full():
+    handler = _emit_handler()
+    handler.EMIT_BUFFER_SIZE = 100
+    await handler.emit("small")
+    handler.flush.assert_not_called()
+    await handler.emit("x" * 100)
+    handler.flush.assert_awaited_once()
+
+    # the delayed flush was cancelled by the immediate one
+    await asyncio.sleep(handler.EMIT_FLUSH_DELAY * 4)
+    handler.flush.assert_awaited_once()
+
+
+async def test_emit_stream_closed():
+    handler = _emit_handler()
+    handler.EMIT_BUFFER_SIZE = 1
+    handler.flush.side_effect = StreamClosedError()
+    with pytest.raises(Finish):
+        await handler.emit("event")
+
+    # the handler is stopped on the next emit, without writing
+    handler.write.reset_mock()
+    handler.flush.reset_mock()
+    with pytest.raises(Finish):
+        await handler.emit("event")
+    handler.write.assert_not_called()
+    handler.flush.assert_not_called()
+
+
+async def test_image_in_registry_cached():
+    handler = BuildHandler.__new__(BuildHandler)
+    handler.registry = mock.MagicMock()
+    manifest = {"schemaVersion": 2}
+
+    async def get_image_manifest(image, tag):
+        await asyncio.sleep(0.1)
+        return manifest
+
+    handler.registry.get_image_manifest.side_effect = get_image_manifest
+    # unique name, since the cache is shared between handlers
+    repo = f"test/cached-{uuid4()}"
+    image_name = f"example.org/{repo}:abc"
+
+    # concurrent lookups share a single registry request
+    found = await asyncio.gather(
+        handler.image_in_registry(image_name),
+        handler.image_in_registry(image_name),
+    )
+    assert found == [True, True]
+    assert await handler.image_in_registry(image_name)
+    handler.registry.get_image_manifest.assert_called_once_with(repo, "abc")
+
+
+async def test_image_in_registry_after_build():
+    handler = BuildHandler.__new__(BuildHandler)
+    handler.registry = mock.MagicMock()
+
+    async def get_image_manifest(image, tag):
+        return None
+
+    handler.registry.get_image_manifest.side_effect = get_image_manifest
+    image_name = f"example.org/test/built-{uuid4()}:abc"
+    assert not await handler.image_in_registry(image_name)
+
+    # the miss is cached, until the image has been built
+    handler._image_built(image_name)
+    assert await handler.image_in_registry(image_name)
+    handler.registry.get_image_manifest.assert_called_once()
+
+
+@pytest.mark.parametrize(
+    "build_slug,ref",
+    [
+        ("jupyterhub/binderhub", "e6f2b2ffb1f1bc3b1a8cd7b96a2c0ed1f0b9d1a5"),
+        ("a" * 100, "HEAD"),
+        ("ab", "r"),
+        ("UPPER/Case_repo", "Ref-With.Dots"),
+    ],
+)
+def test_build_pod_name(build_slug, ref):
+    escaped_slug, slug_hash = _escape_and_hash(build_slug)
+    build_name = _build_pod_name(escaped_slug, slug_hash, ref)
+    assert build_name == _generate_build_name(build_slug, ref, prefix="build-")
+    assert len(build_name) <= 63
+
+
+@pytest.mark.parametrize(
+    "slug",
+    [
+        "binderhub-ci-repos/minimal-dockerfile",
+        "UPPER_lower.123",
+        "tab\tnewline\n",
+        "",
+        "non-ascii-é日本",
+    ],
+)
+def test_escape_slug(slug):
+    assert _escape_slug(slug) == escapism.escape(
+        slug, safe=set(SAFE_SLUG_CHARS), escape_char="-"
+    )
+
+
+def test_keep_alive_build_handlers():
+    handlers = weakref.WeakSet()
+    open_handler = mock.Mock(spec=BuildHandler)
+    finished_handler = mock.Mock(spec=BuildHandler)
+    handlers.add(open_handler)
+    handlers.add(finished_handler)
+    keep_alive_build_handlers(handlers)
+    open_handler.send_keepalive.assert_called_once_with()
+    finished_handler.send_keepalive.assert_called_once_with()
+
+    # handlers drop out of the set when they are done
+    handlers.discard(finished_handler)
+    keep_alive_build_handlers(handlers)
+    assert open_handler.send_keepalive.call_count == 2
+    assert finished_handler.send_keepalive.call_count == 1
+
+
+def test_keep_alive_build_handlers_error():
+    handlers = weakref.WeakSet()
+    broken_handler = mock.Mock(spec=BuildHandler)
+    broken_handler.request = mock.Mock(uri="/build/gh/broken/HEAD")
+    broken_handler.send_keepalive.side_effect = RuntimeError("broken")
+    open_handler = mock.Mock(spec=BuildHandler)
+    handlers.add(broken_handler)
+    handlers.add(open_handler)
+    keep_alive_build_handlers(handlers)
+    broken_handler.send_keepalive.assert_called_once_with()
+    open_handler.send_keepalive.assert_called_once_with()
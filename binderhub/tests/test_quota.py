@@ -2,49 +2,72 @@
 
 import concurrent.futures
 import json
+import time
 from unittest import mock
 
 import pytest
+from kubernetes import client
 
+from binderhub.binderspawner_mixin import REPO_HASH_LABEL, repo_hash_label_value
 from binderhub.quota import KubernetesLaunchQuota, LaunchQuotaExceeded
 
 
+def _singleuser_pod(image, labeled=True):
+    labels = {"app": "jupyterhub", "component": "singleuser-server"}
+    if labeled:
+        labels[REPO_HASH_LABEL] = repo_hash_label_value(image)
+    return {
+        "metadata": {"labels": labels},
+        "spec": {
+            "containers": [{"image": image}],
+        },
+    }
+
+
+def _matches(selector, labels):
+    for term in selector.split(","):
+        if term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        else:
+            key, value = term.split("=", 1)
+            if labels.get(key) != value:
+                return False
+    return True
+
+
 @pytest.fixture
-def mock_pod_list_resp():
-    r = mock.MagicMock()
-    r.read.return_value = json.dumps(
-        {
-            "items": [
-                {
-                    "spec": {
-                        "containers": [
-                            {"image": "example.org/test/kubernetes_quota:1.2.3"}
-                        ],
-                    },
-                },
-                {
-                    "spec": {
-                        "containers": [
-                            {"image": "example.org/test/kubernetes_quota:latest"}
-                        ],
-                    },
-                },
-                {
-                    "spec": {
-                        "containers": [{"image": "example.org/test/other:abc"}],
-                    },
-                },
-            ]
-        }
-    )
-    f = concurrent.futures.Future()
-    f.set_result(r)
-    return f
+def pods():
+    return [
+        _singleuser_pod("example.org/test/kubernetes_quota:1.2.3"),
+        _singleuser_pod("example.org/test/kubernetes_quota:latest"),
+        _singleuser_pod("example.org/test/other:abc"),
+    ]
+
+
+@pytest.fixture
+def mock_pod_list_resp(pods):
+    def list_pods(method, namespace, label_selector, **kwargs):
+        r = mock.MagicMock()
+        r.read.return_value = json.dumps(
+            {
+                "items": [
+                    pod
+                    for pod in pods
+                    if _matches(label_selector, pod["metadata"]["labels"])
+                ]
+            }
+        )
+        f = concurrent.futures.Future()
+        f.set_result(r)
+        return f
+
+    return list_pods
 
 
 async def test_kubernetes_quota_none(mock_pod_list_resp):
     quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
-    quota.executor.submit.return_value = mock_pod_list_resp
+    quota.executor.submit.side_effect = mock_pod_list_resp
 
     r = await quota.check_repo_quota(
         "example.org/test/kubernetes_quota", {}, "repo.url"
@@ -54,7 +77,22 @@ async def test_kubernetes_quota_none(mock_pod_list_resp):
 
 async def test_kubernetes_quota_allowed(mock_pod_list_resp):
     quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
-    quota.executor.submit.return_value = mock_pod_list_resp
+    quota.executor.submit.side_effect = mock_pod_list_resp
+
+    r = await quota.check_repo_quota(
+        "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+    )
+    # total is only counted if there is a total quota
+    assert r.total is None
+    assert r.matching == 2
+    assert r.quota == 3
+
+
+async def test_kubernetes_quota_total_and_repo_allowed(mock_pod_list_resp):
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), total_quota=4
+    )
+    quota.executor.submit.side_effect = mock_pod_list_resp
 
     r = await quota.check_repo_quota(
         "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
@@ -68,7 +106,7 @@ async def test_kubernetes_quota_total_exceeded(mock_pod_list_resp):
     quota = KubernetesLaunchQuota(
         api=mock.MagicMock(), executor=mock.MagicMock(), total_quota=3
     )
-    quota.executor.submit.return_value = mock_pod_list_resp
+    quota.executor.submit.side_effect = mock_pod_list_resp
 
     with pytest.raises(LaunchQuotaExceeded) as excinfo:
         await quota.check_repo_quota(
@@ -82,7 +120,7 @@ async def test_kubernetes_quota_total_exceeded(mock_pod_list_resp):
 
 async def test_kubernetes_quota_repo_exceeded(mock_pod_list_resp):
     quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
-    quota.executor.submit.return_value = mock_pod_list_resp
+    quota.executor.submit.side_effect = mock_pod_list_resp
 
     with pytest.raises(LaunchQuotaExceeded) as excinfo:
         await quota.check_repo_quota(
@@ -92,3 +130,164 @@ async def test_kubernetes_quota_repo_exceeded(mock_pod_list_resp):
     assert excinfo.value.quota == 2
     assert excinfo.value.used == 2
     assert excinfo.value.status == "repo_quota"
+
+
+async def test_kubernetes_quota_paged():
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), list_page_size=1
+    )
+    pages = {
+        None: {"items": [{}], "metadata": {"continue": "page2"}},
+        "page2": {"items": [{}], "metadata": {"continue": ""}},
+    }
+
+    def list_pods(method, namespace, label_selector, limit, _continue, **kwargs):
+        assert limit == 1
+        r = mock.MagicMock()
+        if f"!{REPO_HASH_LABEL}" in label_selector:
+            r.read.return_value = json.dumps({"items": []})
+        else:
+            r.read.return_value = json.dumps(pages[_continue])
+        f = concurrent.futures.Future()
+        f.set_result(r)
+        return f
+
+    quota.executor.submit.side_effect = list_pods
+
+    r = await quota.check_repo_quota(
+        "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+    )
+    # two pages of labeled pods, one (empty) page of unlabeled pods
+    assert quota.executor.submit.call_count == 3
+    assert r.matching == 2
+
+
+@pytest.mark.parametrize(
+    "pods",
+    [
+        [
+            _singleuser_pod("example.org/test/kubernetes_quota:1.2.3", labeled=False),
+            _singleuser_pod("example.org/test/kubernetes_quota:latest"),
+            _singleuser_pod("example.org/test/other:abc", labeled=False),
+        ]
+    ],
+)
+async def test_kubernetes_quota_unlabeled(mock_pod_list_resp):
+    quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
+    quota.executor.submit.side_effect = mock_pod_list_resp
+
+    with pytest.raises(LaunchQuotaExceeded) as excinfo:
+        await quota.check_repo_quota(
+            "example.org/test/kubernetes_quota", {"quota": 2}, "repo.url"
+        )
+    assert excinfo.value.used == 2
+
+
+def _pod_model(name, image, labeled=True):
+    pod = _singleuser_pod(image, labeled)
+    return client.V1Pod(
+        metadata=client.V1ObjectMeta(
+            name=name,
+            resource_version="1",
+            labels=pod["metadata"]["labels"],
+        ),
+        spec=client.V1PodSpec(
+            containers=[
+                client.V1Container(name="notebook", image=image),
+            ],
+        ),
+    )
+
+
+async def test_kubernetes_quota_watch():
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), total_quota=5
+    )
+    quota.api.list_namespaced_pod.return_value = client.V1PodList(
+        metadata=client.V1ListMeta(resource_version="1"),
+        items=[
+            _pod_model("a", "example.org/test/kubernetes_quota:1.2.3"),
+            _pod_model("b", "example.org/test/other:abc"),
+            _pod_model("d", "example.org/test/kubernetes_quota:1.2.3", False),
+            _pod_model("e", "example.org/test/other:abc", False),
+        ],
+    )
+    events = [
+        {
+            "type": "ADDED",
+            "object": _pod_model("c", "example.org/test/kubernetes_quota:latest"),
+        },
+        {
+            "type": "MODIFIED",
+            "object": _pod_model("c", "example.org/test/kubernetes_quota:latest"),
+        },
+        {"type": "DELETED", "object": _pod_model("b", "example.org/test/other:abc")},
+        {"type": "ERROR", "raw_object": {"code": 410}},
+    ]
+    with mock.patch("binderhub.quota.watch.Watch") as Watch:
+        Watch.return_value.stream.return_value = iter(events)
+        quota._watch_pods()
+
+    r = await quota.check_repo_quota(
+        "example.org/test/kubernetes_quota", {"quota": 4}, "repo.url"
+    )
+    # counts come from the watch, not from listing pods
+    quota.executor.submit.assert_not_called()
+    # unlabeled pods are counted by their image
+    assert r.total == 4
+    assert r.matching == 3
+
+
+async def test_kubernetes_quota_watch_start_stop(mock_pod_list_resp):
+    quota = KubernetesLaunchQuota(api=mock.MagicMock(), executor=mock.MagicMock())
+    quota.executor.submit.side_effect = mock_pod_list_resp
+    quota.api.list_namespaced_pod.return_value = client.V1PodList(
+        metadata=client.V1ListMeta(resource_version="1"), items=[]
+    )
+    quota.start()
+
+    # no quotas, no watch
+    await quota.check_repo_quota("example.org/test/kubernetes_quota", {}, "repo.url")
+    assert quota._watch_thread is None
+
+    with mock.patch("binderhub.quota.watch.Watch") as Watch:
+        Watch.return_value.stream.side_effect = lambda *args, **kwargs: iter(
+            [{"type": "ERROR", "raw_object": {"code": 410}}]
+        )
+        await quota.check_repo_quota(
+            "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+        )
+        assert quota._watch_thread.is_alive()
+
+        quota.stop()
+        quota._watch_thread.join(5)
+        assert not quota._watch_thread.is_alive()
+
+
+async def test_kubernetes_quota_watch_restart_delay(mock_pod_list_resp):
+    quota = KubernetesLaunchQuota(
+        api=mock.MagicMock(), executor=mock.MagicMock(), watch_retry_delay=1
+    )
+    quota.executor.submit.side_effect = mock_pod_list_resp
+    quota.api.list_namespaced_pod.return_value = client.V1PodList(
+        metadata=client.V1ListMeta(resource_version="1"), items=[]
+    )
+    quota.start()
+
+    with mock.patch("binderhub.quota.watch.Watch") as Watch:
+        # the watch fails immediately, every time
+        Watch.return_value.stream.side_effect = lambda *args, **kwargs: iter(
+            [{"type": "ERROR", "raw_object": {"code": 410}}]
+        )
+        await quota.check_repo_quota(
+            "example.org/test/kubernetes_quota", {"quota": 3}, "repo.url"
+        )
+        time.sleep(0.5)
+        # the watch is not restarted within watch_retry_delay
+        assert quota.api.list_namespaced_pod.call_count == 1
+        time.sleep(1)
+        assert quota.api.list_namespaced_pod.call_count == 2
+
+        quota.stop()
+        quota._watch_thread.join(5)
+        assert not quota._watch_thread.is_alive()
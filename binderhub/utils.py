@@ -1,6 +1,7 @@
 """Miscellaneous utilities"""
 
 import ipaddress
+import json
 import time
 from collections import OrderedDict
 from hashlib import blake2b
@@ -17,6 +18,24 @@ from traitlets import Integer, TraitError
 # kubernetes connection issues
 KUBE_REQUEST_TIMEOUT = (3, 30)
 
+# orjson is an optional dependency which speeds up JSON (de)serialization
+# on hot paths, such as streaming build logs
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    json_dumps_bytes = orjson.dumps
+    json_loads = orjson.loads
+else:
+
+    def json_dumps_bytes(obj):
+        """Serialize obj to JSON as utf8 bytes"""
+        return json.dumps(obj).encode("utf8")
+
+    json_loads = json.loads
+
 
 def blake2b_hash_as_int(b):
     """Compute digest of the bytes `b` using the Blake2 hash function.
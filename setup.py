@@ -70,5 +70,8 @@ setup(
         #   for building documentation which inspects the source code.
         #
         "pycurl": ["pycurl"],
+        # orjson is an optional dependency which speeds up JSON handling
+        # when streaming build logs
+        "orjson": ["orjson"],
     },
 )